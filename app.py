@@ -17,26 +17,37 @@
 #       - Tab#1: 🔎 พรีวิว + 📦 ส่งออก PDF ทั้งชุด
 #       - Tab#2: 📚 ข้อมูล (preview) + 🧩 Preset (.json)
 #   ✅ ย้ายสถานะ (Preset / เทมเพลต / CSV) → Sidebar
+#   ✅ เทมเพลตหลายหน้า: ทุกฟิลด์มี page (เริ่มที่ 0) — หน้าที่ไม่มีฟิลด์ active คัดลอกครั้งเดียว/แชร์อ้างอิง
+#   ✅ Cold start/rerun เร็วขึ้น: import fitz/PIL/requests เมื่อใช้จริง, แคช template/layout ด้วย cache_resource,
+#      พรีวิว/ส่งออกเป็น st.fragment (เปลี่ยนแถวพรีวิว → rerun เฉพาะส่วนพรีวิว)
+#   ✅ Grid พรีวิว: thumbnail หลายแถวพร้อมกัน (ใช้ raster เทมเพลตร่วม, overlay เฉพาะข้อความ) + ตรวจข้อความล้นขอบ (max_width)
+#   ✅ Preset v11 แบบ typed (FieldSpec) + ตรวจสอบ/migrate รุ่นเก่า, session เก็บ tuple immutable แทน DataFrame
+#   ✅ Input store: เทมเพลต/CSV เก็บเป็นไฟล์ส่วนตัว (0700/0400) ตาม sha256 + TTL/LRU cleanup — ทุก session ใช้สำเนาเดียวกัน
 #
 # Install deps:
 #   pip install streamlit pandas pillow pymupdf requests
 # =============================================================
 
+import hashlib
+import importlib.util
 import io
 import json
-from typing import List, Optional
+import math
+import os
+import stat
+import tempfile
+import threading
+import time
+import weakref
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import streamlit as st
 import pandas as pd
-import requests
 
-# PDF dependency
-try:
-    import fitz  # PyMuPDF
-except Exception:
-    fitz = None
-
-from PIL import Image  # used to render pixmap previews
+# Heavy deps are imported lazily where used:
+#   fitz (PyMuPDF) → render/export, PIL → preview raster, requests → fetch defaults
+HAS_FITZ = importlib.util.find_spec("fitz") is not None
 
 # ------------------ Default URLs ------------------
 # ใส่ลิงก์หน้าเว็บ GitHub ก็ได้ เดี๋ยวแปลงเป็น raw ให้อัตโนมัติ
@@ -95,6 +106,24 @@ DEFAULT_COVER_FIELDS = [
 ]
 
 STD_FONTS = ["helv", "times", "cour"]  # Built-in fonts for PyMuPDF
+# ชื่อใน UI/preset → ชื่อ base-14 ที่ PyMuPDF รู้จัก ("times" ไม่ใช่ชื่อของ PyMuPDF — Times-Roman คือ "tiro")
+PDF_FONTNAMES = {"helv": "helv", "times": "tiro", "cour": "cour"}
+
+# คอลัมน์หลักของ CSV (เติมให้ถ้าไม่มี และเรียงไว้ก่อนคอลัมน์อื่น)
+CSV_PREF_COLS = ["no", "student_id", "name", "sem1", "sem2", "total", "rating", "grade", "year"]
+
+# Column order of the Layout tables (Body/Cover) — "page" = ดัชนีหน้าในเทมเพลต (0 = หน้าแรก),
+# "max_width" = ความกว้างสูงสุดของข้อความ (pt) สำหรับตรวจล้นขอบ (0 = ไม่จำกัด ใช้ขอบหน้าแทน)
+FIELD_COLS = ["field_key", "label", "active", "page", "x", "y", "max_width", "font", "size", "transform", "align"]
+
+# Content-addressed input store (template PDF / CSV): <INPUT_STORE_DIR>/<sha256><ext>
+# ไดเรกทอรีส่วนตัว (0700) ของผู้ใช้ที่รันแอป — ไฟล์ที่ไม่ได้ใช้เกิน TTL หรือเกินขนาดรวม (เก่าสุดก่อน) ถูกลบ
+INPUT_STORE_DIR = os.environ.get("CANVA_INPUT_STORE", os.path.join(tempfile.gettempdir(), "canva_input_store"))
+INPUT_STORE_TTL = 24 * 3600
+INPUT_STORE_MAX_BYTES = 512 * 1024 * 1024
+
+# Grid preview: scale ของ thumbnail
+THUMB_SCALE = 0.5
 
 # ------------------ Helpers ------------------
 
@@ -104,13 +133,155 @@ def to_raw_github(url: str) -> str:
         return url.replace("github.com/", "raw.githubusercontent.com/").replace("/blob/", "/")
     return url
 
+def _check_private_dir(path: str) -> bool:
+    """ไดเรกทอรีจริง (ไม่ใช่ symlink) ของผู้ใช้ปัจจุบัน — ถ้าเปิดให้คนอื่นอ่านได้จะปรับเป็น 0700."""
+    st_ = os.lstat(path)
+    if stat.S_ISLNK(st_.st_mode) or not stat.S_ISDIR(st_.st_mode):
+        return False
+    if hasattr(os, "getuid") and st_.st_uid != os.getuid():
+        return False
+    if st_.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return True
+
+
+@st.cache_resource(show_spinner=False)
+def _input_store_dir() -> str:
+    """
+    เตรียมไดเรกทอรีของ input store ครั้งเดียวต่อ process: สร้างเป็น 0700
+    ถ้ามีอยู่แล้วแต่เป็น symlink/ของผู้ใช้อื่น หรือสร้าง/ตรวจไม่ได้ (OSError เช่น parent ไม่มี/ไม่มีสิทธิ์)
+    จะไม่ใช้ แล้วใช้ไดเรกทอรีส่วนตัวชั่วคราวแทน (ไม่แชร์ข้าม process)
+    """
+    try:
+        try:
+            os.mkdir(INPUT_STORE_DIR, 0o700)
+        except FileExistsError:
+            pass
+        if _check_private_dir(INPUT_STORE_DIR):
+            return INPUT_STORE_DIR
+        reason = "symlink หรือเป็นของผู้ใช้อื่น"
+    except OSError as e:
+        reason = str(e)
+    st.warning(f"ไม่ใช้ input store {INPUT_STORE_DIR} ({reason}) — ใช้ไดเรกทอรีชั่วคราวแทน")
+    return tempfile.mkdtemp(prefix="canva_input_store-")
+
+
+@st.cache_resource(show_spinner=False)
+def _verified_inputs() -> set:
+    """path ที่ตรวจ digest แล้วใน process นี้."""
+    return set()
+
+
+def _file_matches(path: str, digest: str) -> bool:
+    try:
+        st_ = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISREG(st_.st_mode):
+        return False
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest() == digest
+
+
+def touch_input(path: str) -> bool:
+    """อัปเดต mtime (สำหรับ TTL/LRU) — คืน False ถ้าไฟล์ถูก cleanup ไปแล้ว."""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        _verified_inputs().discard(path)
+        return False
+
+
+def _cleanup_input_store(root: str, keep: str):
+    """
+    ลบไฟล์ที่ไม่ถูกใช้เกิน INPUT_STORE_TTL และไฟล์เก่าสุดจนขนาดรวม ≤ INPUT_STORE_MAX_BYTES
+    ยกเว้นเทมเพลตที่ load_template ยังเปิดค้างอยู่ (fragment พรีวิว/ส่งออกอาจเปิดซ้ำได้ทุกเมื่อ)
+    """
+    now = time.time()
+    in_use = _template_registry().paths()
+    entries = []
+    for name in os.listdir(root):
+        p = os.path.join(root, name)
+        try:
+            st_ = os.lstat(p)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(st_.st_mode):
+            entries.append((st_.st_mtime, st_.st_size, p))
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, p in sorted(entries):
+        if p == keep or p in in_use or (now - mtime <= INPUT_STORE_TTL and total <= INPUT_STORE_MAX_BYTES):
+            continue
+        try:
+            os.unlink(p)
+        except OSError:
+            continue
+        total -= size
+        _verified_inputs().discard(p)
+
+
+def store_input(data: bytes, suffix: str) -> str:
+    """
+    เก็บไฟล์อินพุตแบบ content-addressed แล้วคืนค่า path (ชื่อไฟล์ = sha256 ของเนื้อหา):
+    เนื้อหาเดียวกันจากทุก session ได้ path เดียวกัน เขียนครั้งเดียว (atomic, 0400)
+    ไฟล์ที่มีอยู่แล้วจะถูกตรวจ digest ครั้งแรกที่ใช้ในแต่ละ process ถ้าไม่ตรงจะเขียนทับ
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    root = _input_store_dir()
+    path = os.path.join(root, digest + suffix.lower())
+    verified = _verified_inputs()
+    if path in verified and touch_input(path):
+        return path
+    if _file_matches(path, digest):
+        touch_input(path)
+    else:
+        fd, tmp = tempfile.mkstemp(dir=root, suffix=".part")  # 0600
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.chmod(tmp, 0o400)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        _cleanup_input_store(root, keep=path)
+    verified.add(path)
+    return path
+
+
+def store_upload(uploaded_file) -> str:
+    """UploadedFile → path ใน input store (จำตาม file_id ต่อ session จึงไม่ hash/เขียนซ้ำทุก rerun)."""
+    memo = st.session_state.setdefault("input_store_paths", {})
+    path = memo.get(uploaded_file.file_id)
+    if path is None or not touch_input(path):
+        suffix = os.path.splitext(uploaded_file.name)[1]
+        path = memo[uploaded_file.file_id] = store_input(uploaded_file.getvalue(), suffix)
+    return path
+
+
+def fetch_stored(fetch, url: str) -> Optional[str]:
+    """เรียก fetch_default_* (แคช path ไว้) — ถ้าไฟล์ถูก cleanup ไปแล้วจะดาวน์โหลด/เก็บใหม่."""
+    path = fetch(url)
+    if path is not None and not touch_input(path):
+        fetch.clear()
+        path = fetch(url)
+    return path
+
 @st.cache_data(show_spinner=False, ttl=3600)
-def fetch_default_pdf(url: str) -> Optional[bytes]:
+def fetch_default_pdf(url: str) -> Optional[str]:
+    """Fetch PDF from GitHub into the input store; returns its path."""
     try:
+        import requests
+
         raw_url = to_raw_github(url)
         resp = requests.get(raw_url, timeout=10)
         resp.raise_for_status()
-        return resp.content
+        return store_input(resp.content, ".pdf")
     except Exception as e:
         st.warning(f"โหลดค่าเริ่มต้นจาก {url} ไม่ได้: {e}")
         return None
@@ -119,6 +290,8 @@ def fetch_default_pdf(url: str) -> Optional[bytes]:
 def fetch_default_json(url: str) -> Optional[bytes]:
     """Fetch JSON bytes from GitHub (supports normal or raw URLs)."""
     try:
+        import requests
+
         raw_url = to_raw_github(url)
         resp = requests.get(raw_url, timeout=10)
         resp.raise_for_status()
@@ -128,26 +301,19 @@ def fetch_default_json(url: str) -> Optional[bytes]:
         return None
 
 @st.cache_data(show_spinner=False, ttl=3600)
-def fetch_default_csv(url: str) -> Optional[bytes]:
-    """Fetch CSV bytes from GitHub (supports normal or raw URLs)."""
+def fetch_default_csv(url: str) -> Optional[str]:
+    """Fetch CSV from GitHub (supports normal or raw URLs) into the input store; returns its path."""
     try:
+        import requests
+
         raw_url = to_raw_github(url)
         resp = requests.get(raw_url, timeout=10)
         resp.raise_for_status()
-        return resp.content
+        return store_input(resp.content, ".csv")
     except Exception as e:
         st.warning(f"โหลด CSV เริ่มต้นจาก {url} ไม่ได้: {e}")
         return None
 
-def read_csv_bytes(b: bytes) -> pd.DataFrame:
-    """Read CSV bytes into DataFrame with BOM fallback + header trim."""
-    try:
-        df = pd.read_csv(io.BytesIO(b))
-    except UnicodeDecodeError:
-        df = pd.read_csv(io.BytesIO(b), encoding="utf-8-sig")
-    df = df.rename(columns=lambda c: " ".join(str(c).split()))
-    return df
-
 def try_read_table(uploaded_file) -> pd.DataFrame:
     """Read CSV/Excel into DataFrame and normalize header whitespace."""
     if uploaded_file is None:
@@ -171,6 +337,24 @@ def try_read_table(uploaded_file) -> pd.DataFrame:
         return pd.DataFrame()
     return df
 
+@st.cache_resource(show_spinner=False, max_entries=8)
+def load_records(path: str) -> pd.DataFrame:
+    """
+    Stage: ไฟล์ CSV/Excel ใน input store → DataFrame ที่ canonicalize + เติม/เรียงคอลัมน์แล้ว
+    (parse ครั้งเดียวต่อ digest; ทุก session ได้ object เดียวกัน — อ่านอย่างเดียว ห้ามแก้ไขในที่)
+    """
+    with open(path, "rb") as fh:
+        df = canonicalize_columns(try_read_table(fh))
+    if df.empty:
+        return df
+    # Ensure important columns exist
+    for c in CSV_PREF_COLS:
+        if c not in df.columns:
+            df[c] = ""
+    # Order columns nicely
+    ordered = [c for c in CSV_PREF_COLS if c in df.columns] + [c for c in df.columns if c not in CSV_PREF_COLS]
+    return df[ordered]
+
 def canonicalize_columns(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
         return df
@@ -203,32 +387,214 @@ def canonicalize_columns(df: pd.DataFrame) -> pd.DataFrame:
     out = df.rename(columns=new_cols)
     return out
 
-def build_field_df(existing_cols: List[str], defaults) -> pd.DataFrame:
+# ---------- Layout / Preset model ----------
+
+PRESET_VERSION = 11  # v11: เพิ่ม page / max_width (v10 และรูปแบบ list/fields เก่า migrate ให้อัตโนมัติ)
+
+FONT_TRANSFORMS = ["none", "upper", "lower", "title"]
+ALIGNS = ["left", "center", "right"]
+
+
+class PresetError(ValueError):
+    """Preset/Layout ไม่ผ่านการตรวจสอบ (ข้อความบอกตำแหน่งฟิลด์ที่ผิด)."""
+
+
+class FieldSpec(NamedTuple):
+    """หนึ่งฟิลด์ใน Layout — immutable/hashable จึงเก็บใน session_state และใช้เป็น cache key ได้ตรง ๆ."""
+    field_key: str
+    label: str
+    active: bool
+    page: int
+    x: float
+    y: float
+    max_width: float
+    font: str
+    size: float
+    transform: str
+    align: str
+
+
+Layout = Tuple[FieldSpec, ...]
+
+
+class PresetRecord(NamedTuple):
+    """Preset ที่ parse แล้ว: body/cover=None หมายถึงไม่มีใน preset (เช่นรุ่นเก่าที่มีเฉพาะ Body) → คงค่าเดิม."""
+    body: Optional[Layout]
+    cover: Optional[Layout]
+    digest: str  # sha256 ของ bytes ไฟล์ preset (cache key)
+
+
+def _is_missing(v) -> bool:
+    return v is None or (isinstance(v, float) and v != v)
+
+
+def _native(v):
+    """numpy scalar → Python scalar (ค่าจาก data_editor บางรุ่นของ pandas)."""
+    return v.item() if hasattr(v, "item") and not isinstance(v, (str, bytes)) else v
+
+
+def _as_bool(v, name: str) -> bool:
+    v = _native(v)
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, int) and v in (0, 1):
+        return bool(v)
+    raise PresetError(f"{name} ต้องเป็น true/false (ได้ {v!r})")
+
+
+def _as_number(v, name: str) -> float:
+    v = _native(v)
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        raise PresetError(f"{name} ต้องเป็นตัวเลข (ได้ {v!r})")
+    try:
+        f = float(v)
+    except OverflowError:
+        raise PresetError(f"{name} ใหญ่เกินไป") from None
+    if not math.isfinite(f):
+        raise PresetError(f"{name} ต้องเป็นตัวเลขจำกัด (ได้ {v!r})")
+    return f
+
+
+def _as_str(v, name: str) -> str:
+    v = _native(v)
+    if not isinstance(v, str):
+        raise PresetError(f"{name} ต้องเป็นข้อความ (ได้ {v!r})")
+    return v
+
+
+def field_from_dict(d: dict, where: str = "field") -> FieldSpec:
+    """ตรวจ/แปลง dict (จาก JSON หรือแถวของ data_editor) → FieldSpec; ค่าที่ผิดจะ raise PresetError."""
+    if not isinstance(d, dict):
+        raise PresetError(f"{where}: ต้องเป็น object")
+    missing = [k for k in ("field_key", "x", "y") if _is_missing(d.get(k))]
+    if missing:
+        raise PresetError(f"{where}: ขาดคีย์ {missing}")
+    key = _as_str(d["field_key"], f"{where}.field_key")
+    where = f"{where} ({key})"
+
+    def opt(name: str, conv, default):
+        v = d.get(name)
+        return default if _is_missing(v) else conv(v, f"{where}.{name}")
+
+    page = opt("page", _as_number, 0.0)
+    if page < 0 or not page.is_integer():
+        raise PresetError(f"{where}.page ต้องเป็นจำนวนเต็ม ≥ 0 (ได้ {d.get('page')!r})")
+    max_width = opt("max_width", _as_number, 0.0)
+    if max_width < 0:
+        raise PresetError(f"{where}.max_width ต้อง ≥ 0")
+    size = opt("size", _as_number, 12.0)
+    if size <= 0:
+        raise PresetError(f"{where}.size ต้องมากกว่า 0")
+    font = opt("font", _as_str, "helv")
+    transform = opt("transform", _as_str, "none")
+    align = opt("align", _as_str, "left")
+    return FieldSpec(
+        field_key=key,
+        label=opt("label", _as_str, key.title()),
+        active=opt("active", _as_bool, False),
+        page=int(page),
+        x=_as_number(d["x"], f"{where}.x"),
+        y=_as_number(d["y"], f"{where}.y"),
+        max_width=max_width,
+        # ฟอนต์/ตัวเลือกที่ไม่รู้จัก → ค่าเริ่มต้น (เหมือนตอนวาดที่ใช้ helv แทนฟอนต์ที่ไม่รองรับ)
+        font=font if font in STD_FONTS else "helv",
+        size=size,
+        transform=transform if transform in FONT_TRANSFORMS else "none",
+        align=align if align in ALIGNS else "left",
+    )
+
+
+def layout_from_records(fields, where: str = "fields") -> Layout:
+    if not isinstance(fields, list):
+        raise PresetError(f"{where}: ต้องเป็น list")
+    return tuple(field_from_dict(f, f"{where}[{i}]") for i, f in enumerate(fields))
+
+
+def layout_from_df(df: pd.DataFrame) -> Layout:
+    return layout_from_records(df.to_dict(orient="records"))
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def layout_to_df(layout: Layout) -> pd.DataFrame:
+    """แปลงเป็น DataFrame เฉพาะตอนส่งให้ data_editor."""
+    return pd.DataFrame([f._asdict() for f in layout], columns=FIELD_COLS)
+
+
+def migrate_preset(raw) -> dict:
+    """แปลง Preset ทุกรุ่นให้เป็นโครงสร้างปัจจุบัน {"version", "body": {...}, "cover": {...} | None}."""
+    # Back-compat: list/fields => Body only
+    if isinstance(raw, list):
+        return {"version": PRESET_VERSION, "body": {"fields": raw}, "cover": None}
+    if not isinstance(raw, dict):
+        raise PresetError("Preset ต้องเป็น JSON object หรือ list")
+    if "fields" in raw:
+        return {"version": PRESET_VERSION, "body": {"fields": raw["fields"]}, "cover": None}
+    version = raw.get("version", PRESET_VERSION)
+    if not isinstance(version, int) or version > PRESET_VERSION:
+        raise PresetError(f"ไม่รองรับ Preset version {version!r} (สูงสุด {PRESET_VERSION})")
+    if not isinstance(raw.get("body") or {}, dict) or not isinstance(raw.get("cover") or {}, dict):
+        raise PresetError("body/cover ต้องเป็น object")
+    # v10 → v11: page/max_width ใช้ค่าเริ่มต้นใน field_from_dict
+    return {"version": PRESET_VERSION, "body": raw.get("body") or {}, "cover": raw.get("cover")}
+
+
+def parse_preset(preset_bytes: bytes) -> PresetRecord:
+    """bytes ของ layout_preset.json → PresetRecord (ตรวจสอบครบ; แคชตาม sha256 ของไฟล์ แชร์ข้าม session)."""
+    return _parse_preset_cached(hashlib.sha256(preset_bytes).hexdigest(), preset_bytes)
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _parse_preset_cached(digest: str, _preset_bytes: bytes) -> PresetRecord:
+    # _preset_bytes ขึ้นต้นด้วย "_" → Streamlit ไม่ hash ซ้ำ ใช้ digest เป็น cache key
+    preset_bytes = _preset_bytes
+    try:
+        raw = json.loads(preset_bytes.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise PresetError(f"JSON ไม่ถูกต้อง: {e}") from None
+    data = migrate_preset(raw)
+    body_raw, cover_raw = data["body"], data["cover"] or {}
+    body = layout_from_records(body_raw["fields"], "body.fields") if "fields" in body_raw else None
+    cover = layout_from_records(cover_raw["fields"], "cover.fields") if "fields" in cover_raw else None
+    # cover.data_row_index ไม่ถูกอ่าน: ปกใช้ข้อมูลแถว 0 เสมอ (ส่งออกเป็น 0 เพื่อ back-compat)
+    return PresetRecord(body, cover, digest)
+
+
+def preset_to_bytes(body: Layout, cover: Layout) -> bytes:
+    payload = {
+        "version": PRESET_VERSION,
+        "body": {"fields": [f._asdict() for f in body]},
+        "cover": {
+            "fields": [f._asdict() for f in cover],
+            "data_row_index": 0,
+        },
+    }
+    buf = io.StringIO(); json.dump(payload, buf, ensure_ascii=False, indent=2)
+    return buf.getvalue().encode("utf-8")
+
+
+def _default_spec(k: str, label: str, active: bool, x, y, font, size, transform, align) -> FieldSpec:
+    return FieldSpec(k, label, bool(active), 0, float(x), float(y), 0.0, str(font), float(size),
+                     str(transform), str(align))
+
+
+def _generic_spec(k: str) -> FieldSpec:
+    return FieldSpec(k, k.title(), False, 0, 100.0, 100.0, 0.0, "helv", 12.0, "none", "left")
+
+
+def build_layout(existing_cols: List[str], defaults) -> Layout:
     rows = []
     existing = set(existing_cols)
     known = set()
     for k, label, active, x, y, font, size, transform, align in defaults:
-        rows.append({
-            "field_key": k,
-            "label": label,
-            # เปิดอัตโนมัติถ้าอยู่ใน CSV หรือเป็นคีย์สำคัญ (name/id/total/no)
-            "active": active if k in existing or k in ["name", "student_id", "total", "no"] else False,
-            "x": x, "y": y, "font": font, "size": size,
-            "transform": transform, "align": align
-        })
+        # เปิดอัตโนมัติถ้าอยู่ใน CSV หรือเป็นคีย์สำคัญ (name/id/total/no)
+        on = active if k in existing or k in ["name", "student_id", "total", "no"] else False
+        rows.append(_default_spec(k, label, on, x, y, font, size, transform, align))
         known.add(k)
     # เติมคอลัมน์ที่โผล่มาใหม่ใน CSV
-    for c in existing:
+    for c in existing_cols:
         if c not in known:
-            rows.append({
-                "field_key": c,
-                "label": c.title(),
-                "active": False, "x": 100.0, "y": 100.0,
-                "font": "helv", "size": 12,
-                "transform": "none", "align": "left"
-            })
-    df = pd.DataFrame(rows)
-    return df
+            rows.append(_generic_spec(c))
+    return tuple(rows)
 
 def apply_transform(text, mode: str) -> str:
     if text is None or (isinstance(text, float) and pd.isna(text)):
@@ -251,21 +617,29 @@ def get_record_display(rec: pd.Series, key_cols=("student_id", "name")) -> str:
 
 # ---------- Measurement compatible with all PyMuPDF versions ----------
 
+def _pdf_fontname(font: str) -> str:
+    """ชื่อฟอนต์ของ layout → fontname ของ PyMuPDF (ใช้ทั้งตอนวัดและตอนวาด) — ไม่รู้จัก → helv."""
+    return PDF_FONTNAMES.get(font, "helv")
+
+
+@lru_cache(maxsize=None)
+def _std_font(fontname: str):
+    import fitz
+
+    return fitz.Font(fontname=fontname)
+
+
 def _measure_text_width(page, text: str, font: str, size: float) -> float:
     """Compatible width calc: Page.get_text_length (new) -> Font.text_length (fallback) -> heuristic."""
     # 1) PyMuPDF รุ่นใหม่
     if hasattr(page, "get_text_length"):
         try:
-            return page.get_text_length(
-                text,
-                fontname=font if font in STD_FONTS else "helv",
-                fontsize=size,
-            )
+            return page.get_text_length(text, fontname=_pdf_fontname(font), fontsize=size)
         except Exception:
             pass
     # 2) Fallback: ใช้ fitz.Font คำนวณ
     try:
-        f = fitz.Font(fontname=font if font in STD_FONTS else "helv")
+        f = _std_font(_pdf_fontname(font))
         try:
             return f.text_length(text, fontsize=size)  # ใหม่
         except TypeError:
@@ -285,55 +659,226 @@ def _aligned_xy(page, text: str, x: float, y: float, font: str, size: float, ali
     return x, y
 
 
-def render_preview_with_pymupdf(template_bytes: bytes, fields_df: pd.DataFrame,
-                                record: pd.Series, scale: float = 2.0):
-    if fitz is None:
-        raise RuntimeError("PyMuPDF (fitz) is not available")
-    td = fitz.open(stream=template_bytes, filetype="pdf")
-    if td.page_count != 1:
-        st.warning("เทมเพลตต้องเป็น PDF หน้าเดียว จะใช้หน้าแรกแทน")
-    newdoc = fitz.open()
-    newdoc.insert_pdf(td, from_page=0, to_page=0)
-    p = newdoc[0]
+@st.cache_resource(show_spinner=False, max_entries=64)
+def fields_by_page(layout: Layout) -> Dict[int, Layout]:
+    """
+    "คอมไพล์" Layout: จัดกลุ่มฟิลด์ active ตามหน้า {page: (field, ...)} — หน้าที่ไม่อยู่ใน dict คือหน้า static
+    (cache_resource → ผลลัพธ์แชร์ข้าม rerun/session ห้ามแก้ไข)
+    """
+    pages: Dict[int, List[FieldSpec]] = {}
+    for f in layout or ():
+        if f.active:
+            pages.setdefault(f.page, []).append(f)
+    return {p: tuple(fs) for p, fs in pages.items()}
 
-    for _, row in fields_df.iterrows():
-        if not row["active"]:
-            continue
-        key = row["field_key"]
+
+def _draw_fields_on_page(page, fields: Layout, record: pd.Series):
+    for f in fields:
+        key = f.field_key
         if key not in record or pd.isna(record[key]):
             continue
-        text = apply_transform(record[key], row["transform"])
-        x, y = float(row["x"]), float(row["y"])
-        font = row.get("font", "helv")
-        size = float(row.get("size", 12))
-        align = row.get("align", "left")
-        ax, ay = _aligned_xy(p, str(text), x, y, font, size, align)
+        text = apply_transform(record[key], f.transform)
+        x, y = f.x, f.y
+        font = f.font
+        size = f.size
+        align = f.align
+        ax, ay = _aligned_xy(page, str(text), x, y, font, size, align)
         try:
-            p.insert_text((ax, ay), str(text), fontname=font if font in STD_FONTS else "helv",
-                          fontsize=size, color=(0, 0, 0))
+            page.insert_text((ax, ay), str(text), fontname=_pdf_fontname(font),
+                             fontsize=size, color=(0, 0, 0))
         except Exception:
-            p.insert_text((ax, ay), str(text), fontname="helv", fontsize=size, color=(0, 0, 0))
+            page.insert_text((ax, ay), str(text), fontname="helv", fontsize=size, color=(0, 0, 0))
+
+
+class ParsedTemplate:
+    """เทมเพลต PDF ที่ parse แล้ว ใช้แบบอ่านอย่างเดียว — lock กันการเรียก fitz.Document เดียวกันพร้อมกันหลาย session."""
+
+    def __init__(self, template_path: str):
+        import fitz
+
+        # เปิดจากไฟล์ใน input store โดยตรง (MuPDF อ่านจากดิสก์ ไม่ต้องถือสำเนา bytes ไว้ใน Python)
+        self.path = template_path
+        self.doc = fitz.open(template_path, filetype="pdf")
+        self.page_count = self.doc.page_count
+        self.page_sizes = tuple((pg.rect.width, pg.rect.height) for pg in self.doc)
+        self.lock = threading.Lock()
+        _template_registry().add(self)
+
+
+class _TemplateRegistry:
+    """ParsedTemplate ที่ยังมีชีวิตอยู่ (weakref — หลุดเองเมื่อ cache_resource evict แล้วไม่มีใครถืออยู่)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._live = weakref.WeakSet()
+
+    def add(self, tpl: "ParsedTemplate"):
+        with self._lock:
+            self._live.add(tpl)
+
+    def paths(self) -> set:
+        with self._lock:
+            return {tpl.path for tpl in self._live}
+
+
+@st.cache_resource(show_spinner=False)
+def _template_registry() -> _TemplateRegistry:
+    return _TemplateRegistry()
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def load_template(template_path: str) -> ParsedTemplate:
+    return ParsedTemplate(template_path)
+
+
+def pdf_page_count(template_path: str) -> int:
+    return load_template(template_path).page_count
+
+
+def _pixmap_to_image(pix):
+    from PIL import Image
+
+    return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+
+# raster แคชเป็น bytes ต่อ process (A4 ที่ scale 2 ≈ 6 MB/ภาพ) — จำกัดจำนวน + ttl เพื่อคุมหน่วยความจำ
+@st.cache_data(show_spinner=False, max_entries=8, ttl=600)
+def render_static_page(template_path: str, page_index: int, scale: float = 2.0):
+    """Raster ของหน้าเทมเพลตที่ไม่มีฟิลด์ — ไม่ขึ้นกับแถวข้อมูล จึงแคชระดับหน้าได้."""
+    import fitz
+
+    tpl = load_template(template_path)
+    with tpl.lock:
+        pix = tpl.doc[page_index].get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+    return _pixmap_to_image(pix)
+
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=600)
+def render_preview_with_pymupdf(template_path: str, layout: Layout,
+                                record: pd.Series, scale: float = 2.0, page_index: int = 0):
+    if not HAS_FITZ:
+        raise RuntimeError("PyMuPDF (fitz) is not available")
+    import fitz
+
+    page_fields = fields_by_page(layout).get(int(page_index))
+    if not page_fields:
+        return render_static_page(template_path, int(page_index), scale)
+
+    tpl = load_template(template_path)
+    newdoc = fitz.open()
+    with tpl.lock:
+        newdoc.insert_pdf(tpl.doc, from_page=page_index, to_page=page_index)
+    p = newdoc[0]
+    _draw_fields_on_page(p, page_fields, record)
 
     mat = fitz.Matrix(scale, scale)
     pix = p.get_pixmap(matrix=mat, alpha=False)
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-    td.close(); newdoc.close()
-    return img
+    newdoc.close()
+    return _pixmap_to_image(pix)
 
-# ---- NEW: auto-sync helpers ----
 
-def _defaults_to_rowmap(defaults):
-    m = {}
-    for k, label, active, x, y, font, size, transform, align in defaults:
-        m[k] = {
-            "field_key": k, "label": label, "active": bool(active),
-            "x": float(x), "y": float(y), "font": str(font), "size": int(size),
-            "transform": str(transform), "align": str(align)
-        }
-    return m
+def fields_out_of_range(layout: Layout, n_pages: int) -> List[str]:
+    """field_key ของฟิลด์ active ที่ page >= จำนวนหน้าของเทมเพลต (จะไม่ถูกวาดลงหน้าใด)."""
+    return [f.field_key for f in layout or () if f.active and f.page >= n_pages]
 
 
-def reconcile_fields(layout_df: pd.DataFrame, csv_cols: List[str], defaults) -> pd.DataFrame:
+def build_batch_pdf(out, template_path: str, layout: Layout, records) -> int:
+    """
+    วาดเทมเพลต (ทุกหน้า) ลงใน out หนึ่งชุดต่อแถวข้อมูล แล้ววาดเฉพาะหน้าที่มีฟิลด์ active
+      - insert_pdf ไม่แชร์ object ข้ามการเรียก (คัดลอกทุกครั้ง → 36 แถว ≈ 2 MB)
+        จึงใช้ show_pdf_page แทน: หน้าเทมเพลตแต่ละหน้าถูกฝังเป็น Form XObject ครั้งเดียว
+        แล้วทุกชุดอ้างอิง XObject เดิม (36 แถว ≈ 85 KB)
+      - หน้าที่มีฟิลด์ได้แค่ overlay stream ใหม่ต่อแถว
+    ฟิลด์ที่ page เกินจำนวนหน้าจะถูกข้าม — ผู้เรียกควรเตือนด้วย fields_out_of_range ก่อน
+    คืนค่าจำนวนหน้าที่เพิ่มเข้าไป
+    """
+    # ใช้ document ที่ load_template เปิดค้างไว้ (ไม่เปิดไฟล์ใหม่ — ไฟล์ใน store อาจถูก cleanup ไปแล้ว)
+    tpl = load_template(template_path)
+    page_fields = {p: f for p, f in fields_by_page(layout).items() if p < tpl.page_count}
+    added = 0
+    with tpl.lock:
+        for rec in records:
+            for pno, (w, h) in enumerate(tpl.page_sizes):
+                page = out.new_page(width=w, height=h)
+                page.show_pdf_page(page.rect, tpl.doc, pno)
+                if pno in page_fields:
+                    _draw_fields_on_page(page, page_fields[pno], rec)
+            added += tpl.page_count
+    return added
+
+# ---- Grid preview (thumbnail) + ตรวจข้อความล้นขอบ ----
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def find_overflows(layout: Layout, records_df: pd.DataFrame,
+                   page_sizes: Tuple[Tuple[float, float], ...]) -> pd.DataFrame:
+    """
+    วัดความกว้างข้อความทุกแถว × ทุกฟิลด์ active (ด้วย _measure_text_width) แล้วคืนรายการที่ล้นขอบ:
+      - max_width > 0: ข้อความกว้างกว่า max_width
+      - ทุกฟิลด์: ข้อความ (หลังจัด align) เลยขอบซ้าย/ขวาของหน้า
+    """
+    cols = ["row", "field_key", "page", "text", "width", "limit"]
+    hits = []
+    for pno, flds in fields_by_page(layout).items():
+        if pno >= len(page_sizes):
+            continue
+        page_w = page_sizes[pno][0]
+        for f in flds:
+            key = f.field_key
+            if key not in records_df.columns:
+                continue
+            size, font, max_w, align = f.size, f.font, f.max_width, f.align
+            for i, val in enumerate(records_df[key].tolist()):
+                if val is None or pd.isna(val):
+                    continue
+                text = apply_transform(val, f.transform)
+                w = _measure_text_width(None, text, font, size)
+                x0 = f.x - (w / 2.0 if align == "center" else w if align == "right" else 0.0)
+                if (max_w > 0 and w > max_w) or x0 < 0 or x0 + w > page_w:
+                    hits.append((i, key, pno, text, round(w, 1), max_w if max_w > 0 else page_w))
+    return pd.DataFrame(hits, columns=cols)
+
+
+def _render_overlay_thumb(base, overlay_doc, page_size: Tuple[float, float], fields: Layout,
+                          record: pd.Series, scale: float):
+    """วาดเฉพาะข้อความบนหน้าเปล่า (alpha) แล้ว composite ลงบน raster เทมเพลตที่ใช้ร่วมกัน."""
+    import fitz
+    from PIL import Image
+
+    page = overlay_doc.new_page(width=page_size[0], height=page_size[1])
+    _draw_fields_on_page(page, fields, record)
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=True)
+    overlay_doc.delete_page(-1)
+    overlay = Image.frombytes("RGBA", [pix.width, pix.height], pix.samples)
+    if overlay.size != base.size:
+        overlay = overlay.resize(base.size)
+    return Image.alpha_composite(base, overlay).convert("RGB")
+
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=600)
+def render_thumbnail_batch(template_path: str, layout: Layout, records_df: pd.DataFrame,
+                           page_index: int = 0, scale: float = THUMB_SCALE) -> list:
+    """
+    Thumbnail ความละเอียดต่ำของหลายแถว (แคชต่อหน้า grid):
+    raster เทมเพลต render ครั้งเดียว (render_static_page) แล้วแต่ละแถวแค่ overlay ข้อความ
+    render ทีละแถวใน thread เดียว — PyMuPDF ไม่รองรับการเรียกพร้อมกันหลาย thread
+    """
+    import fitz
+
+    base = render_static_page(template_path, int(page_index), scale).convert("RGBA")
+    fields = fields_by_page(layout).get(int(page_index), ())
+    if not fields:
+        return [base.convert("RGB")] * len(records_df)
+    page_size = load_template(template_path).page_sizes[int(page_index)]
+    overlay_doc = fitz.open()
+    try:
+        return [_render_overlay_thumb(base, overlay_doc, page_size, fields, rec, scale)
+                for _, rec in records_df.iterrows()]
+    finally:
+        overlay_doc.close()
+
+# ---- NEW: auto-sync helpers ----
+
+def reconcile_fields(layout: Optional[Layout], csv_cols: List[str], defaults) -> Layout:
     """
     ซิงค์แผง Layout (Body/Cover) ให้ตามคอลัมน์ CSV:
       - คีย์ที่มีอยู่แล้ว: เก็บค่าตำแหน่ง/ฟอนต์เดิม
@@ -341,39 +886,31 @@ def reconcile_fields(layout_df: pd.DataFrame, csv_cols: List[str], defaults) ->
       - คีย์ที่หายไปจาก CSV: คงไว้แต่ปิด active (กันเผื่อ preset เก่า)
       - ✅ 'no' จะถูกซิงค์เหมือนคอลัมน์อื่น ๆ (ไม่ถูกข้าม/ลบทิ้ง)
     """
-    if layout_df is None or layout_df.empty:
-        return build_field_df(csv_cols, defaults)
+    if not layout:
+        return build_layout(csv_cols, defaults)
 
-    existing = {str(r["field_key"]): dict(r) for _, r in layout_df.iterrows()}
-    dmap = _defaults_to_rowmap(defaults)
+    existing = {f.field_key: f for f in layout}
+    dmap = {d[0]: _default_spec(*d) for d in defaults}
 
     rows = []
     for c in csv_cols:
         if c in existing:
             rows.append(existing[c])
         else:
-            base = dmap.get(c, {
-                "field_key": c, "label": c.title(), "active": False,
-                "x": 100.0, "y": 100.0, "font": "helv", "size": 12,
-                "transform": "none", "align": "left"
-            })
-            rows.append(base)
-
-    for k, row in existing.items():
+            rows.append(dmap.get(c) or _generic_spec(c))
+
+    for k, f in existing.items():
         if k not in csv_cols:
-            row = {**row, "active": False}
-            rows.append(row)
+            rows.append(f._replace(active=False))
 
-    df_new = pd.DataFrame(rows)
-    want = ["field_key","label","active","x","y","font","size","transform","align"]
-    return df_new[want]
+    return tuple(rows)
 
 # ------------------ Streamlit UI ------------------
 
 st.set_page_config(page_title="PDF Layout Editor — CSV (Unified) → Batch PDF [PDF-only]", layout="wide")
 st.title("🖨️ PDF Layout Editor")
 
-if fitz is None:
+if not HAS_FITZ:
     st.error("ต้องติดตั้ง PyMuPDF ก่อนใช้งาน: `pip install pymupdf`")
     st.stop()
 
@@ -390,60 +927,56 @@ with st.sidebar:
     csv_main = st.file_uploader("CSV หลัก)", type=["csv", "xlsx", "xls"]) 
 
 # Auto-fetch defaults if not uploaded
-default_body_bytes = None
-default_cover_bytes = None
-default_csv_bytes = None
+default_body_path = None
+default_cover_path = None
+default_csv_path = None
 body_source = "uploaded" if tpl_pdf is not None else "github"
 cover_source = "uploaded" if tpl_cover_pdf is not None else "github"
 csv_source = "uploaded" if csv_main is not None else "github"
 
 if tpl_pdf is None:
-    default_body_bytes = fetch_default_pdf(DEFAULT_BODY_URL)
-    if default_body_bytes is None:
+    default_body_path = fetch_stored(fetch_default_pdf, DEFAULT_BODY_URL)
+    if default_body_path is None:
         body_source = "missing"
 if cover_active and tpl_cover_pdf is None:
-    default_cover_bytes = fetch_default_pdf(DEFAULT_COVER_URL)
-    if default_cover_bytes is None:
+    default_cover_path = fetch_stored(fetch_default_pdf, DEFAULT_COVER_URL)
+    if default_cover_path is None:
         cover_source = "missing"
 if csv_main is None:
-    default_csv_bytes = fetch_default_csv(DEFAULT_CSV_URL)
-    if default_csv_bytes is None:
+    default_csv_path = fetch_stored(fetch_default_csv, DEFAULT_CSV_URL)
+    if default_csv_path is None:
         csv_source = "missing"
 
+# Template paths in the input store — resolve once per run (stages below reuse them)
+body_path = store_upload(tpl_pdf) if tpl_pdf is not None else default_body_path
+cover_path = store_upload(tpl_cover_pdf) if tpl_cover_pdf is not None else default_cover_path
+
 # === Load Data & Initialize State ===
 if csv_main is not None:
-    df = canonicalize_columns(try_read_table(csv_main))
+    active_df = load_records(store_upload(csv_main))
 else:
-    if default_csv_bytes is not None:
-        df = canonicalize_columns(read_csv_bytes(default_csv_bytes))
+    if default_csv_path is not None:
+        active_df = load_records(default_csv_path)
     else:
         st.warning("อัปโหลด CSV ตามสคีมาใหม่ก่อน หรือระบบโหลดจาก GitHub ไม่สำเร็จ")
         st.stop()
 
-if df.empty:
+if active_df.empty:
     st.warning("CSV ว่างเปล่า")
     st.stop()
 
-# Ensure important columns exist
-for c in ["no", "student_id", "name", "sem1", "sem2", "total", "rating", "grade", "year"]:
-    if c not in df.columns:
-        df[c] = ""
-
-# Order columns nicely
-pref = ["no", "student_id", "name", "sem1", "sem2", "total", "rating", "grade", "year"]
-ordered = [c for c in pref if c in df.columns] + [c for c in df.columns if c not in pref]
-active_df = df[ordered]
+ordered = active_df.columns.tolist()
 
 # Remember CSV signature & auto-sync layouts
 st.session_state["current_csv_cols"] = ordered
 csv_sig = tuple(ordered)
 prev_sig = st.session_state.get("csv_signature")
 
-# Ensure field DFs exist
-if "fields_df" not in st.session_state:
-    st.session_state["fields_df"] = build_field_df(ordered, DEFAULT_FIELDS)
-if "cover_fields_df" not in st.session_state:
-    st.session_state["cover_fields_df"] = build_field_df(ordered, DEFAULT_COVER_FIELDS)
+# Ensure layouts exist (session เก็บ Layout = tuple ของ FieldSpec — แปลงเป็น DataFrame เฉพาะตอนแก้ใน editor)
+if "body_layout" not in st.session_state:
+    st.session_state["body_layout"] = build_layout(ordered, DEFAULT_FIELDS)
+if "cover_layout" not in st.session_state:
+    st.session_state["cover_layout"] = build_layout(ordered, DEFAULT_COVER_FIELDS)
 if "preset_loaded" not in st.session_state:
     st.session_state["preset_loaded"] = False
 if "preset_url_used" not in st.session_state:
@@ -451,11 +984,11 @@ if "preset_url_used" not in st.session_state:
 
 # Auto-sync on CSV change
 if prev_sig != csv_sig:
-    st.session_state["fields_df"] = reconcile_fields(
-        st.session_state["fields_df"], ordered, DEFAULT_FIELDS
+    st.session_state["body_layout"] = reconcile_fields(
+        st.session_state["body_layout"], ordered, DEFAULT_FIELDS
     )
-    st.session_state["cover_fields_df"] = reconcile_fields(
-        st.session_state["cover_fields_df"], ordered, DEFAULT_COVER_FIELDS
+    st.session_state["cover_layout"] = reconcile_fields(
+        st.session_state["cover_layout"], ordered, DEFAULT_COVER_FIELDS
     )
     st.session_state["csv_signature"] = csv_sig
     st.toast("ซิงค์ Layout กับ CSV แล้ว (อัตโนมัติ)", icon="🔄")
@@ -464,46 +997,22 @@ if prev_sig != csv_sig:
 
 def _apply_unified_preset_bytes(preset_bytes: bytes, source_label: str):
     try:
-        raw = json.loads(preset_bytes.decode("utf-8"))
-        # Back-compat: list/fields => Body only
-        if isinstance(raw, list) or "fields" in raw:
-            fields_list = raw.get("fields", raw if isinstance(raw, list) else [])
-            new_df = pd.DataFrame(fields_list)
-            req = ["field_key", "label", "active", "x", "y", "font", "size", "transform", "align"]
-            missing = [c for c in req if c not in new_df.columns]
-            if missing:
-                st.error(f"Preset JSON ขาดคีย์: {missing}")
-                return
-            st.session_state["fields_df"] = new_df[req]
-            # reconcile with current CSV
-            csv_cols = st.session_state.get("current_csv_cols")
-            if csv_cols:
-                st.session_state["fields_df"] = reconcile_fields(
-                    st.session_state["fields_df"], csv_cols, DEFAULT_FIELDS
-                )
-            st.session_state["preset_loaded"] = True
-            st.session_state["preset_url_used"] = source_label
-            st.info("โหลดเฉพาะ Body (legacy) จาก Preset แล้ว")
-        else:
-            body = raw.get("body", {})
-            cover = raw.get("cover", {})
-            if "fields" in body:
-                st.session_state["fields_df"] = pd.DataFrame(body["fields"])
-            if "fields" in cover:
-                st.session_state["cover_fields_df"] = pd.DataFrame(cover["fields"])
-            csv_cols = st.session_state.get("current_csv_cols")
-            if csv_cols:
-                st.session_state["fields_df"] = reconcile_fields(
-                    st.session_state["fields_df"], csv_cols, DEFAULT_FIELDS
-                )
-                st.session_state["cover_fields_df"] = reconcile_fields(
-                    st.session_state["cover_fields_df"], csv_cols, DEFAULT_COVER_FIELDS
-                )
-            st.session_state["preset_loaded"] = True
-            st.session_state["preset_url_used"] = source_label
-            st.success("นำเข้า Preset (Body + Cover) สำเร็จ")
-    except Exception as e:
+        preset = parse_preset(preset_bytes)
+    except PresetError as e:
         st.error(f"อ่านไฟล์/URL Preset ไม่ได้: {e}")
+        return
+    csv_cols = st.session_state.get("current_csv_cols")
+    if preset.body is not None:
+        st.session_state["body_layout"] = reconcile_fields(preset.body, csv_cols, DEFAULT_FIELDS) if csv_cols else preset.body
+    if preset.cover is not None:
+        st.session_state["cover_layout"] = reconcile_fields(preset.cover, csv_cols, DEFAULT_COVER_FIELDS) if csv_cols else preset.cover
+    st.session_state["preset_loaded"] = True
+    st.session_state["preset_url_used"] = source_label
+    st.session_state["preset_digest"] = preset.digest
+    if preset.cover is None:
+        st.info("โหลดเฉพาะ Body (legacy) จาก Preset แล้ว")
+    else:
+        st.success("นำเข้า Preset (Body + Cover) สำเร็จ")
 
 # Auto-load preset once if not loaded
 if not st.session_state["preset_loaded"]:
@@ -521,6 +1030,8 @@ with st.sidebar:
             st.success("Preset: ใช้ไฟล์ที่อัปโหลด")
         else:
             st.info(f"Preset: โหลดจาก GitHub อัตโนมัติ\n{src}")
+        if st.session_state.get("preset_digest"):
+            st.caption(f"sha256: {st.session_state['preset_digest'][:12]}")
     else:
         st.warning("Preset: ยังไม่พบ (ระบบพยายามโหลดอัตโนมัติจาก GitHub)")
 
@@ -558,110 +1069,168 @@ tab1, tab2 = st.tabs([
 
 # ---- Tab 1: Preview + Export ----
 with tab1:
-    st.subheader("🔎 พรีวิว")
     idx_options = list(range(len(active_df)))
     if len(idx_options) == 0:
         st.stop()
 
-    rec_idx = st.number_input("แถวที่ต้องการพรีวิว (Body)", min_value=0, max_value=len(idx_options)-1, value=0, step=1)
-    record_body = active_df.iloc[int(rec_idx)]
-
     # Cover record = row 0 ALWAYS
     cov_idx = 0
     record_cover = active_df.iloc[cov_idx]
 
-    page_type = st.radio("หน้าไหน", ["Body", "Cover"], index=0, horizontal=True)
-
-    def _draw_fields_on_page(page, fields_df: pd.DataFrame, record: pd.Series):
-        for _, row in fields_df.iterrows():
-            if not row["active"]:
-                continue
-            key = row["field_key"]
-            if key not in record or pd.isna(record[key]):
-                continue
-            text = apply_transform(record[key], row["transform"])
-            x, y = float(row["x"]), float(row["y"])
-            font = row.get("font", "helv")
-            size = float(row.get("size", 12))
-            align = row.get("align", "left")
-            ax, ay = _aligned_xy(page, str(text), x, y, font, size, align)
+    def _touch_templates():
+        """fragment rerun ไม่ผ่าน store_upload/fetch_stored — touch path เอง (กัน TTL/LRU cleanup)
+        ถ้าไฟล์ถูกลบไปแล้ว rerun ทั้งแอปเพื่อเก็บ/ดาวน์โหลดใหม่."""
+        paths = [p for p in (body_path, cover_path if cover_active else None) if p is not None]
+        if not all([touch_input(p) for p in paths]):
+            st.rerun()
+
+    def _warn_out_of_range(label: str, layout: Layout, src: str):
+        n_pages = pdf_page_count(src)
+        missing = fields_out_of_range(layout, n_pages)
+        if missing:
+            st.warning(f"{label}: ฟิลด์ {missing} ตั้ง page เกินจำนวนหน้าของเทมเพลต ({n_pages} หน้า, 0–{n_pages - 1}) "
+                       "— จะไม่แสดงในพรีวิว/ไฟล์ส่งออก")
+
+    def _preview_page_picker(src: str, key: str) -> int:
+        """เลือกหน้าเทมเพลตที่จะพรีวิว (แสดงเฉพาะเมื่อเทมเพลตมีหลายหน้า)."""
+        n_pages = pdf_page_count(src)
+        if n_pages <= 1:
+            return 0
+        return int(st.number_input(f"หน้าเทมเพลต (0–{n_pages - 1})", min_value=0,
+                                   max_value=n_pages - 1, value=0, step=1, key=key))
+
+    def _grid_preview():
+        """Grid thumbnail ของ Body หลายแถว + สรุปแถวที่ข้อความล้นขอบ (render ทีละหน้า grid ตามที่เปิดดู)."""
+        if body_path is None:
+            st.info("อัปโหลด Template PDF ของ Body หรือให้ระบบโหลดค่าเริ่มต้นจาก GitHub (ตรวจสอบเครือข่าย)")
+            return
+        body_layout = st.session_state["body_layout"]
+        _warn_out_of_range("Body", body_layout, body_path)
+        overflows = find_overflows(body_layout, active_df, load_template(body_path).page_sizes)
+        flagged = sorted(set(overflows["row"].tolist()))
+        if flagged:
+            st.warning(f"ข้อความล้นขอบ {len(flagged)} แถว จาก {len(active_df)} แถว")
+            with st.expander("รายการที่ล้นขอบ", expanded=False):
+                st.dataframe(overflows, use_container_width=True, hide_index=True)
+        else:
+            st.success(f"ไม่พบข้อความล้นขอบ ({len(active_df)} แถว)")
+
+        c1, c2, c3, c4 = st.columns(4)
+        only_flagged = c1.checkbox("เฉพาะแถวที่ล้นขอบ", value=False, disabled=not flagged)
+        per_page = int(c2.selectbox("ต่อหน้า", [12, 24, 48], index=1))
+        n_cols = int(c3.selectbox("คอลัมน์", [3, 4, 6], index=1))
+        rows = flagged if only_flagged else list(range(len(active_df)))
+        n_grid_pages = max(1, -(-len(rows) // per_page))
+        grid_page = int(c4.number_input(f"หน้า grid (1–{n_grid_pages})", min_value=1,
+                                        max_value=n_grid_pages, value=1, step=1))
+        body_page = _preview_page_picker(body_path, "grid_page_body")
+
+        shown = rows[(grid_page - 1) * per_page: grid_page * per_page]
+        thumbs = render_thumbnail_batch(body_path, body_layout, active_df.iloc[shown], body_page, THUMB_SCALE)
+        flagged_set = set(flagged)
+        grid = st.columns(n_cols)
+        for k, (i, img) in enumerate(zip(shown, thumbs)):
+            mark = "⚠️ " if i in flagged_set else ""
+            grid[k % n_cols].image(img, caption=f"{mark}#{i} — {get_record_display(active_df.iloc[i])}",
+                                   use_container_width=True)
+
+    # Stage: พรีวิว — widget ในนี้ rerun เฉพาะ fragment (ไม่รัน CSV/Layout/Preset ทั้งสคริปต์ใหม่)
+    @st.fragment
+    def preview_stage():
+        st.subheader("🔎 พรีวิว")
+        _touch_templates()
+        mode = st.radio("โหมดพรีวิว", ["ทีละแถว", "Grid (thumbnail)"], index=0, horizontal=True)
+        if mode != "ทีละแถว":
             try:
-                page.insert_text((ax, ay), str(text), fontname=font if font in STD_FONTS else "helv",
-                                 fontsize=size, color=(0,0,0))
-            except Exception:
-                page.insert_text((ax, ay), str(text), fontname="helv", fontsize=size, color=(0,0,0))
+                _grid_preview()
+            except Exception as e:
+                st.error(f"พรีวิว Grid ผิดพลาด: {e}")
+            return
 
-    try:
-        if page_type == "Body":
-            body_src = tpl_pdf.getvalue() if tpl_pdf is not None else default_body_bytes
-            if body_src is not None:
-                st.image(
-                    render_preview_with_pymupdf(body_src, st.session_state["fields_df"], record_body, 2.0),
-                    caption=f"Body — {get_record_display(record_body)}",
-                    use_container_width=True,
-                )
-                if body_source == "github" and tpl_pdf is None:
-                    st.caption(f"กำลังใช้ Body จาก GitHub: {to_raw_github(DEFAULT_BODY_URL)}")
-                # st.caption("Body: หน่วย X/Y = จุด (pt) — มุมซ้ายบนคือ (0,0)")
-            else:
-                st.info("อัปโหลด Template PDF ของ Body หรือให้ระบบโหลดค่าเริ่มต้นจาก GitHub (ตรวจสอบเครือข่าย)")
-        else:  # Cover
-            if cover_active:
-                cover_src = tpl_cover_pdf.getvalue() if tpl_cover_pdf is not None else default_cover_bytes
-                if cover_src is not None:
+        rec_idx = st.number_input("แถวที่ต้องการพรีวิว (Body)", min_value=0, max_value=len(idx_options)-1, value=0, step=1)
+        record_body = active_df.iloc[int(rec_idx)]
+
+        page_type = st.radio("หน้าไหน", ["Body", "Cover"], index=0, horizontal=True)
+
+        try:
+            if page_type == "Body":
+                if body_path is not None:
+                    _warn_out_of_range("Body", st.session_state["body_layout"], body_path)
+                    body_page = _preview_page_picker(body_path, "preview_page_body")
                     st.image(
-                        render_preview_with_pymupdf(cover_src, st.session_state["cover_fields_df"], record_cover, 2.0),
-                        caption=f"Cover — ใช้ข้อมูลแถวที่ 0 (แถวแรก) — {get_record_display(record_cover)}",
+                        render_preview_with_pymupdf(body_path, st.session_state["body_layout"], record_body, 2.0, body_page),
+                        caption=f"Body — หน้า {body_page} — {get_record_display(record_body)}",
                         use_container_width=True,
                     )
-                    if cover_source == "github" and tpl_cover_pdf is None:
-                        st.caption(f"กำลังใช้ Cover จาก GitHub: {to_raw_github(DEFAULT_COVER_URL)}")
-                    st.caption("Cover: หน่วย X/Y = จุด (pt) — มุมซ้ายบนคือ (0,0) • ใช้ข้อมูลจากแถวที่ 0 เสมอ")
+                    if body_source == "github" and tpl_pdf is None:
+                        st.caption(f"กำลังใช้ Body จาก GitHub: {to_raw_github(DEFAULT_BODY_URL)}")
+                    # st.caption("Body: หน่วย X/Y = จุด (pt) — มุมซ้ายบนคือ (0,0)")
                 else:
-                    st.info("เปิด Active ปก แล้ว—อัปโหลด Cover Template PDF หรือให้ระบบโหลดค่าเริ่มต้นจาก GitHub (ตรวจสอบเครือข่าย)")
-            else:
-                st.info("ยังไม่ได้เปิด Active ปก (หน้าแรกครั้งเดียว)")
-    except Exception as e:
-        st.error(f"พรีวิวผิดพลาด: {e}")
+                    st.info("อัปโหลด Template PDF ของ Body หรือให้ระบบโหลดค่าเริ่มต้นจาก GitHub (ตรวจสอบเครือข่าย)")
+            else:  # Cover
+                if cover_active:
+                    if cover_path is not None:
+                        _warn_out_of_range("Cover", st.session_state["cover_layout"], cover_path)
+                        cover_page = _preview_page_picker(cover_path, "preview_page_cover")
+                        st.image(
+                            render_preview_with_pymupdf(cover_path, st.session_state["cover_layout"], record_cover, 2.0, cover_page),
+                            caption=f"Cover — หน้า {cover_page} — ใช้ข้อมูลแถวที่ 0 (แถวแรก) — {get_record_display(record_cover)}",
+                            use_container_width=True,
+                        )
+                        if cover_source == "github" and tpl_cover_pdf is None:
+                            st.caption(f"กำลังใช้ Cover จาก GitHub: {to_raw_github(DEFAULT_COVER_URL)}")
+                        st.caption("Cover: หน่วย X/Y = จุด (pt) — มุมซ้ายบนคือ (0,0) • ใช้ข้อมูลจากแถวที่ 0 เสมอ")
+                    else:
+                        st.info("เปิด Active ปก แล้ว—อัปโหลด Cover Template PDF หรือให้ระบบโหลดค่าเริ่มต้นจาก GitHub (ตรวจสอบเครือข่าย)")
+                else:
+                    st.info("ยังไม่ได้เปิด Active ปก (หน้าแรกครั้งเดียว)")
+        except Exception as e:
+            st.error(f"พรีวิวผิดพลาด: {e}")
+
+    preview_stage()
 
     st.divider()
-    st.subheader("📦 ส่งออก PDF ทั้งชุด")
 
-    if st.button("🚀 Export PDF"):
-        try:
-            body_src = tpl_pdf.getvalue() if tpl_pdf is not None else default_body_bytes
-            if body_src is None:
-                st.error("ไม่มี Template PDF ของ Body (อัปโหลดหรือให้ระบบโหลดค่าเริ่มต้นจาก GitHub)")
-            else:
-                out = fitz.open()
+    # Stage: ส่งออก — ปุ่ม/ดาวน์โหลด rerun เฉพาะ fragment นี้
+    @st.fragment
+    def export_stage():
+        st.subheader("📦 ส่งออก PDF ทั้งชุด")
 
-                # Insert global cover once using row 0
-                if cover_active:
-                    cover_src = tpl_cover_pdf.getvalue() if tpl_cover_pdf is not None else default_cover_bytes
-                    if cover_src is not None:
-                        t_cover = fitz.open(stream=cover_src, filetype="pdf")
-                        out.insert_pdf(t_cover, from_page=0, to_page=0)
-                        page0 = out[-1]
-                        _draw_fields_on_page(page0, st.session_state["cover_fields_df"], record_cover)
-                        t_cover.close()
-                    else:
-                        st.warning("ไม่พบ Cover Template — จะข้ามหน้า Cover")
-
-                # Insert body pages per student
-                for _, rec in active_df.iterrows():
-                    t_body = fitz.open(stream=body_src, filetype="pdf")
-                    out.insert_pdf(t_body, from_page=0, to_page=0)
-                    page = out[-1]
-                    _draw_fields_on_page(page, st.session_state["fields_df"], rec)
-                    t_body.close()
-
-                pdf_bytes = out.tobytes(); out.close()
-                total_pages = len(active_df) + (1 if (cover_active and (tpl_cover_pdf is not None or default_cover_bytes is not None)) else 0)
-                st.success(f"เสร็จแล้ว: {total_pages} หน้า (ปก 1 + เนื้อหา {len(active_df)})")
-                st.download_button("⬇️ ดาวน์โหลด PDF", data=pdf_bytes,
-                                   file_name="exported_batch_with_global_cover.pdf", mime="application/pdf")
-        except Exception as e:
-            st.error(f"ส่งออกไม่สำเร็จ: {e}")
+        if st.button("🚀 Export PDF"):
+            _touch_templates()
+            try:
+                if body_path is None:
+                    st.error("ไม่มี Template PDF ของ Body (อัปโหลดหรือให้ระบบโหลดค่าเริ่มต้นจาก GitHub)")
+                else:
+                    import fitz
+
+                    out = fitz.open()
+
+                    # Insert global cover once using row 0
+                    cover_pages = 0
+                    if cover_active:
+                        if cover_path is not None:
+                            _warn_out_of_range("Cover", st.session_state["cover_layout"], cover_path)
+                            cover_pages = build_batch_pdf(out, cover_path, st.session_state["cover_layout"], [record_cover])
+                        else:
+                            st.warning("ไม่พบ Cover Template — จะข้ามหน้า Cover")
+
+                    # Insert body pages per student (ทุกหน้าของเทมเพลต Body ต่อ 1 แถว)
+                    _warn_out_of_range("Body", st.session_state["body_layout"], body_path)
+                    body_pages = build_batch_pdf(
+                        out, body_path, st.session_state["body_layout"],
+                        (rec for _, rec in active_df.iterrows()),
+                    )
+
+                    pdf_bytes = out.tobytes(garbage=1, deflate=True); out.close()
+                    total_pages = cover_pages + body_pages
+                    st.success(f"เสร็จแล้ว: {total_pages} หน้า (ปก {cover_pages} + เนื้อหา {body_pages} จาก {len(active_df)} แถว)")
+                    st.download_button("⬇️ ดาวน์โหลด PDF", data=pdf_bytes,
+                                       file_name="exported_batch_with_global_cover.pdf", mime="application/pdf")
+            except Exception as e:
+                st.error(f"ส่งออกไม่สำเร็จ: {e}")
+
+    export_stage()
 
 # ---- Tab 2: Data preview + Preset UI ----
 with tab2:
@@ -677,7 +1246,11 @@ with tab2:
             load_from_url = st.button("⬇️ โหลด Preset จาก URL")
 
             if preset_json is not None:
-                _apply_unified_preset_bytes(preset_json.read(), "uploaded")
+                # uploader คืนไฟล์เดิมทุก rerun → นำเข้าเฉพาะเมื่อเป็นการอัปโหลดใหม่ (file_id ใหม่ทุกครั้งที่อัปโหลด
+                # แม้เนื้อหาเดิม) จึงไม่ทับค่าที่แก้ใน Layout แต่อัปโหลดไฟล์เดิมซ้ำเพื่อย้อนกลับได้
+                if st.session_state.get("preset_upload_id") != preset_json.file_id:
+                    _apply_unified_preset_bytes(preset_json.getvalue(), "uploaded")
+                    st.session_state["preset_upload_id"] = preset_json.file_id
             if load_from_url:
                 b = fetch_default_json(preset_url)
                 if b:
@@ -685,16 +1258,8 @@ with tab2:
 
         with col_e:
             try:
-                payload = {
-                    "version": 10,
-                    "body": {"fields": st.session_state["fields_df"].to_dict(orient="records")},
-                    "cover": {
-                        "fields": st.session_state["cover_fields_df"].to_dict(orient="records"),
-                        "data_row_index": 0,
-                    },
-                }
-                buf = io.StringIO(); json.dump(payload, buf, ensure_ascii=False, indent=2)
-                st.download_button("⬇️ Export Preset (.json)", data=buf.getvalue().encode("utf-8"),
+                preset_out = preset_to_bytes(st.session_state["body_layout"], st.session_state["cover_layout"])
+                st.download_button("⬇️ Export Preset (.json)", data=preset_out,
                                    file_name="layout_preset_body_cover.json", mime="application/json")
             except Exception as e:
                 st.error(f"Export JSON ผิดพลาด: {e}")
@@ -702,48 +1267,59 @@ with tab2:
     with st.expander("🔁 Sync Layout กับ CSV (กดเองถ้าจำเป็น)", expanded=False):
         if st.button("Resync now"):
             cols = st.session_state.get("current_csv_cols", active_df.columns.tolist())
-            st.session_state["fields_df"] = reconcile_fields(st.session_state["fields_df"], cols, DEFAULT_FIELDS)
-            st.session_state["cover_fields_df"] = reconcile_fields(st.session_state["cover_fields_df"], cols, DEFAULT_COVER_FIELDS)
+            st.session_state["body_layout"] = reconcile_fields(st.session_state["body_layout"], cols, DEFAULT_FIELDS)
+            st.session_state["cover_layout"] = reconcile_fields(st.session_state["cover_layout"], cols, DEFAULT_COVER_FIELDS)
             st.toast("Resynced!", icon="✅")
 
+    def _commit_layout_edit(state_key: str, edited: pd.DataFrame):
+        """ผลจาก data_editor → Layout (ถ้าค่าไม่ผ่านการตรวจสอบ คง Layout เดิมไว้)."""
+        try:
+            st.session_state[state_key] = layout_from_df(edited)
+        except PresetError as e:
+            st.error(f"ค่าใน Layout ไม่ถูกต้อง: {e}")
+
     tab_body, tab_cover = st.tabs(["⚙️ Body Layout", "⚙️ Cover Layout"])
     with tab_body:
         edited_body = st.data_editor(
-            st.session_state["fields_df"],
+            layout_to_df(st.session_state["body_layout"]),
             use_container_width=True, hide_index=True,
             column_config={
                 "field_key": st.column_config.TextColumn("field_key", disabled=True),
                 "label": st.column_config.TextColumn("Label"),
                 "active": st.column_config.CheckboxColumn("Active"),
+                "page": st.column_config.NumberColumn("Page", min_value=0, step=1, format="%d"),
                 "x": st.column_config.NumberColumn("X", step=1, format="%.1f"),
                 "y": st.column_config.NumberColumn("Y", step=1, format="%.1f"),
+                "max_width": st.column_config.NumberColumn("Max W (pt)", min_value=0, step=1, format="%.0f"),
                 "font": st.column_config.SelectboxColumn("Font", options=STD_FONTS),
                 "size": st.column_config.NumberColumn("Size (pt)", step=1, format="%.0f"),
-                "transform": st.column_config.SelectboxColumn("Case", options=["none", "upper", "lower", "title"]),
-                "align": st.column_config.SelectboxColumn("Align", options=["left", "center", "right"]),
+                "transform": st.column_config.SelectboxColumn("Case", options=FONT_TRANSFORMS),
+                "align": st.column_config.SelectboxColumn("Align", options=ALIGNS),
             },
             key="fields_editor_body",
         )
-        st.session_state["fields_df"] = edited_body
+        _commit_layout_edit("body_layout", edited_body)
 
     with tab_cover:
         edited_cover = st.data_editor(
-            st.session_state["cover_fields_df"],
+            layout_to_df(st.session_state["cover_layout"]),
             use_container_width=True, hide_index=True,
             column_config={
                 "field_key": st.column_config.TextColumn("field_key", disabled=True),
                 "label": st.column_config.TextColumn("Label"),
                 "active": st.column_config.CheckboxColumn("Active"),
+                "page": st.column_config.NumberColumn("Page", min_value=0, step=1, format="%d"),
                 "x": st.column_config.NumberColumn("X", step=1, format="%.1f"),
                 "y": st.column_config.NumberColumn("Y", step=1, format="%.1f"),
+                "max_width": st.column_config.NumberColumn("Max W (pt)", min_value=0, step=1, format="%.0f"),
                 "font": st.column_config.SelectboxColumn("Font", options=STD_FONTS),
                 "size": st.column_config.NumberColumn("Size (pt)", step=1, format="%.0f"),
-                "transform": st.column_config.SelectboxColumn("Case", options=["none", "upper", "lower", "title"]),
-                "align": st.column_config.SelectboxColumn("Align", options=["left", "center", "right"]),
+                "transform": st.column_config.SelectboxColumn("Case", options=FONT_TRANSFORMS),
+                "align": st.column_config.SelectboxColumn("Align", options=ALIGNS),
             },
             key="fields_editor_cover",
         )
-        st.session_state["cover_fields_df"] = edited_cover
+        _commit_layout_edit("cover_layout", edited_cover)
 
 st.markdown("---")
 # st.caption(